@@ -1,6 +1,60 @@
-import random
 from mesa import Agent
 from enum import Enum
+from bisect import bisect_left
+from numba import njit
+
+# all possible bridge conditions; the position in the list is the uint8 condition code
+# that is stored in the bridge arrays of the model
+CONDITIONS = ("A", "B", "C", "D", "X")
+CONDITION_CODES = {condition: code for code, condition in enumerate(CONDITIONS)}
+X_CODE = CONDITION_CODES["X"]
+# the condition a bridge gets when it deteriorates; a collapsed bridge cannot deteriorate any further
+NEXT_CONDITION = {"A": "B", "B": "C", "C": "D", "D": "X", "X": "X"}
+
+# bridges are put in length buckets 0 (very short) up to LONG_BUCKET (long) by the length thresholds of the model;
+# the bucket determines the delay time of a collapsed bridge
+LONG_BUCKET = 3
+
+# the time it takes to repair a collapsed bridge: 1 day
+REPAIR_TIME = 24 * 60
+
+# the kind of each Infra (Infra.KIND), also used on a flattened path, see BangladeshModel.get_path_arrays
+LINK_KIND = 0
+BRIDGE_KIND = 1
+SINK_KIND = 2
+SOURCE_KIND = 3
+SOURCESINK_KIND = 4
+
+# the reasons why advance stops driving
+ON_INFRA = 0
+AT_SINK = 1
+AT_BRIDGE = 2
+
+
+@njit(cache=True)
+def advance(location_index, distance, kinds, lengths, bridges, bridge_cond, bridge_right):
+    """
+    Drive the given distance along a flattened path, starting at the end of the Infra at location_index
+
+    Stops at the Infra where the distance runs out (ON_INFRA), at the sink (AT_SINK),
+    or at a bridge that needs to be handled by the vehicle itself (AT_BRIDGE):
+    a collapsed bridge that may cause a delay, or an R bridge that is skipped.
+
+    Returns the index of the Infra where the vehicle stopped, the distance left and the reason for stopping
+    """
+    while True:
+        location_index += 1
+        kind = kinds[location_index]
+        if kind == SINK_KIND or kind == SOURCESINK_KIND:
+            return location_index, distance, AT_SINK
+        if kind == BRIDGE_KIND:
+            bridge = bridges[location_index]
+            if bridge_right[bridge] or bridge_cond[bridge] == X_CODE:
+                return location_index, distance, AT_BRIDGE
+        if lengths[location_index] > distance:
+            return location_index, distance, ON_INFRA
+        distance -= lengths[location_index]
+
 
 # ---------------------------------------------------------------
 
@@ -23,8 +77,18 @@ class Infra(Agent):
     vehicle_count : int
         the number of vehicles that are currently in/on (or totally generated/removed by)
         this infrastructure component
+
+    infra_idx : int
+        the dense index of this infrastructure component in the infra_list of the model
+
+    kind : int
+        the kind of infrastructure component (KIND of its class), to avoid isinstance checks
     """
 
+    __slots__ = ('length', 'name', 'road_name', 'vehicle_count', 'kind', 'infra_idx', 'pos')
+
+    KIND = LINK_KIND
+
     def __init__(self, unique_id, model, length=0,
                  name='Unknown', road_name='Unknown'):
         super().__init__(unique_id, model)
@@ -32,6 +96,8 @@ class Infra(Agent):
         self.name = name
         self.road_name = road_name
         self.vehicle_count = 0
+        self.kind = self.KIND
+        self.infra_idx = self.model.register_infra(self)
 
     def step(self):
         pass
@@ -43,10 +109,25 @@ class Infra(Agent):
 # ---------------------------------------------------------------
 class Bridge(Infra):
     """
+    A bridge is a thin view on its slot (idx) in the bridge arrays of the model.
+    Collapsing and repairing is done for all bridges at once in BangladeshModel.step_bridges.
+
     Attributes
     __________
+    idx : int
+        the index of this bridge in the bridge arrays of the model
+
     condition : string
-        condition of the bridge
+        condition of the bridge, one of CONDITIONS (A if not given)
+
+    cond_code : int
+        condition of the bridge as its index in CONDITIONS
+
+    is_right : bool
+        whether the bridge is the R bridge of an L/R pair
+
+    length_bucket : int
+        0 for very short, up to LONG_BUCKET for long bridges
 
     collapse_chance : float
         the chance that a bridge can collapse, based on the condtion of the bridge
@@ -56,50 +137,87 @@ class Bridge(Infra):
         either True or False
 
     repair_time : int
-        the time it takes to repair a bridge
-        is set to 1 day
+        the time (in ticks) it takes to repair a collapsed bridge
+        is set to 1 day; the repair is finished repair_time + 1 ticks after the collapse
 
     delay_time : int
         the delay (in ticks) caused by this bridge
     """
 
+    # the other attributes are properties on the bridge arrays of the model
+    __slots__ = ('idx', 'is_right', 'length_bucket', 'repair_time')
+
+    KIND = BRIDGE_KIND
+
     def __init__(self, unique_id, model, length=0,
-                 name='Unknown', road_name='Unknown', condition='Unknown'):
+                 name='Unknown', road_name='Unknown', condition='A'):
         super().__init__(unique_id, model, length, name, road_name)
 
+        # claim a slot in the bridge arrays of the model
+        self.idx = self.model.register_bridge(self)
+        # whether this is the R bridge of an L/R pair, which vehicles skip
+        self.is_right = self.name.endswith('(R')
+        self.model.bridge_right[self.idx] = self.is_right
+        self.length_bucket = bisect_left([self.model.short_length_threshold,
+                                          self.model.medium_length_threshold,
+                                          self.model.long_length_threshold], self.length)
+        self.model.bridge_bucket[self.idx] = self.length_bucket
         self.condition = condition
         # the collapse chance of a bridge is determined based on the key, value pairs
-        # in the dictionary attribute of the model.
-        self.collapse_chance = self.model.collapse_dict.get(self.condition)
+        # in the dictionary attribute of the model, looked up by condition code.
+        self.collapse_chance = self.model.collapse_chance_by_code[self.cond_code]
         self.in_repair = False
-        self.repair_time = self.get_repair_time()
+        self.repair_time = REPAIR_TIME
         self.delay_time = 0
 
+    @property
+    def condition(self):
+        return CONDITIONS[self.model.bridge_cond[self.idx]]
+
+    @condition.setter
+    def condition(self, condition):
+        self.model.bridge_cond[self.idx] = CONDITION_CODES[condition]
+
+    @property
+    def cond_code(self):
+        return int(self.model.bridge_cond[self.idx])
+
+    @property
+    def collapse_chance(self):
+        return float(self.model.bridge_cc[self.idx])
+
+    @collapse_chance.setter
+    def collapse_chance(self, collapse_chance):
+        self.model.bridge_cc[self.idx] = collapse_chance
+
+    @property
+    def in_repair(self):
+        return bool(self.model.bridge_repair[self.idx])
+
+    @in_repair.setter
+    def in_repair(self, in_repair):
+        self.model.bridge_repair[self.idx] = in_repair
+
+    @property
+    def delay_time(self):
+        return float(self.model.bridge_delay[self.idx])
+
+    @delay_time.setter
+    def delay_time(self, delay_time):
+        self.model.bridge_delay[self.idx] = delay_time
+
     def get_delay_time(self):
         """
         Determines the delay time of all bridges with condition X i.e. all bridges that are collapsed,
         depends on the length of the bridge
         """
-        if self.condition == "X":
-            if self.length > self.model.long_length_threshold:
-                self.delay_time = random.triangular(60, 240, 120)
-            elif self.length > self.model.medium_length_threshold:
-                self.delay_time = random.uniform(45, 90)
-            elif self.length > self.model.short_length_threshold:
-                self.delay_time = random.uniform(15, 60)
-            else:
-                self.delay_time = random.uniform(10, 20)
+        if self.cond_code == X_CODE:
+            # the delay times of all bridges are drawn at once each tick in BangladeshModel.fill_delay_buf
+            self.delay_time = self.model.delay_buf[self.idx]
         else:
             pass
         return self.delay_time
 
-    def get_repair_time(self):
-        """
-        Sets the repair time of a collapsed bridge to 1 day
-        """
-        self.repair_time = 24*60
-        return self.repair_time
-
     def get_name(self):
         """
         Retrieve bridges name to choose between L/R bridge
@@ -113,17 +231,6 @@ class Bridge(Infra):
         self.condition = new_condition
         return self.condition
 
-    def collapse(self):
-        """
-        A bridge collapses according to its chance of collapsing.
-        A collapsed bridge will get the condition 'X'.
-        """
-        if self.collapse_chance > random.random():
-            self.change_condition("X")
-        else:
-            pass
-        return
-
     def deteriorate(self):
         """
         A bridge's condition deteriorates
@@ -134,32 +241,14 @@ class Bridge(Infra):
         # or for example,if a small storm happens,bridge conditions can deteriorate.
         # please note that deterioration of a bridge is not the same as collapse of a bridge!
 
-        condition_list = ["A", "B", "C", "D", "X"]  # list of all possible bridge conditions
         # if a bridge is already in the worst condition ("X"), it cannot deteriorate any further
-        if self.condition == "X":
+        if self.cond_code == X_CODE:
             pass
         else:
             # for the remaining conditions, deteriorate the bridge by setting the condition to one condition worse
-            # get the index in the condition_list of the current bridge condition
-            condition_index = condition_list.index(self.condition)
-            # increase index by 1 and set that condition to the new current bridge condition
-            self.condition = condition_list[condition_index+1]
+            self.condition = NEXT_CONDITION[self.condition]
             return self.condition
 
-    def check_repair(self):
-        # if the bridge is not yet in repair, but it is collapsed, set it in repair status
-        if not self.in_repair and self.condition == "X":
-            self.in_repair = True
-            self.delay_time = self.get_delay_time()
-        # if bridge is in repair, check if its repair time is already finished
-        elif self.in_repair:
-            if self.repair_time == 0:
-                self.finish_repair()
-            else:
-                # if the counter is not zero, condition is still collapsed. Counter is decreased with one.
-                self.repair_time -= 1
-        return
-
     def finish_repair(self):
         """
         A bridge is repaired
@@ -168,10 +257,7 @@ class Bridge(Infra):
         # repair the bridge by setting the condition to condition A
         # condition before collapse would also be possible. But assumption was made that bridge condition will
         # increase when repairing bridge.
-        # if the counter is zero, change the condition
         self.change_condition("A")
-        # reset repair time of bridge
-        self.repair_time = self.get_repair_time()
         # set in_repair to False
         self.in_repair = False
         # bridge will not be delayed due to repair anymore, so set delay_time back to 0
@@ -179,17 +265,13 @@ class Bridge(Infra):
         return
 
     def step(self):
-        # first, the bridge has a chance to collapse. This is done in the collapse function.
-        self.collapse()
-        # Optional: let the bridge deteriorate
-        # self.deteriorate()
-        # Next, check if bridge needs repair and if repair is finished.
-        self.check_repair()
+        # bridges collapse and get repaired all at once in BangladeshModel.step_bridges
+        pass
 # ---------------------------------------------------------------
 
 
 class Link(Infra):
-    pass
+    KIND = LINK_KIND
 # ---------------------------------------------------------------
 
 
@@ -204,12 +286,15 @@ class Sink(Infra):
     ...
 
     """
+    KIND = SINK_KIND
     vehicle_removed_toggle = False
 
     def remove(self, vehicle):
-        self.model.schedule.remove(vehicle)
+        # the vehicle is removed from the schedule at the end of the tick, see BangladeshModel.step
+        self.model.pending_remove.append(vehicle)
         self.vehicle_removed_toggle = not self.vehicle_removed_toggle
-        print(str(self) + ' REMOVE ' + str(vehicle))
+        if self.model.trace_enabled:
+            self.model.trace(self, 'REMOVE', vehicle)
 
 
 # ---------------------------------------------------------------
@@ -233,31 +318,14 @@ class Source(Infra):
 
     """
 
+    KIND = SOURCE_KIND
     truck_counter = 0
     generation_frequency = 5
     vehicle_generated_flag = False
 
     def step(self):
-        if self.model.schedule.steps % self.generation_frequency == 0:
-            self.generate_truck()
-        else:
-            self.vehicle_generated_flag = False
-
-    def generate_truck(self):
-        """
-        Generates a truck, sets its path, increases the global and local counters
-        """
-        try:
-            agent = Vehicle('Truck' + str(Source.truck_counter), self.model, self)
-            if agent:
-                self.model.schedule.add(agent)
-                agent.set_path()
-                Source.truck_counter += 1
-                self.vehicle_count += 1
-                self.vehicle_generated_flag = True
-                print(str(self) + " GENERATE " + str(agent))
-        except Exception as e:
-            print("Oops!", e.__class__, "occurred.")
+        # trucks are generated by all sources at once in BangladeshModel.step_sources
+        pass
 
 
 # ---------------------------------------------------------------
@@ -265,7 +333,7 @@ class SourceSink(Source, Sink):
     """
     Generates and removes trucks
     """
-    pass
+    KIND = SOURCESINK_KIND
 
 
 # ---------------------------------------------------------------
@@ -292,10 +360,15 @@ class Vehicle(Agent):
         the Infra, which has a certain length
         i.e. location_offset < length
 
-    path_ids: Series
+    path_ids: np.ndarray
         the whole path (origin and destination) where the vehicle shall drive
         It consists the Infras' uniques IDs in a sequential order
 
+    path_idx, path_kind, path_length, path_bridge: np.ndarray
+        the flattened path: for each Infra in "path_ids" its index in the infra_list of the model,
+        and, as used by advance, its kind, its length, and its index in the bridge arrays of the model
+        (-1 if not a bridge)
+
     location_index: int
         a pointer to the current Infra in "path_ids" (above)
         i.e. the id of self.location is self.path_ids[self.location_index]
@@ -316,6 +389,11 @@ class Vehicle(Agent):
         the driving time on the road for a vehicle
     """
 
+    __slots__ = ('generated_by', 'generated_at_step', 'location', 'location_offset', 'pos',
+                 'path_ids', 'path_idx', 'path_kind', 'path_length', 'path_bridge',
+                 'state', 'location_index', 'waiting_time', 'waited_at', 'removed_at_step',
+                 'next_infra_name', 'next_infra_location', 'driving_time')
+
     # 50 km/h translated into meter per min
     speed = 50 * 1000 / 60
     # One tick represents 1 minute
@@ -340,7 +418,7 @@ class Vehicle(Agent):
         self.waiting_time = 0
         self.waited_at = None
         self.removed_at_step = None
-        # set an attribute 'next_infra_name' to distinguish the L and R bridge
+        # set an attribute 'next_infra_name' to keep track of the next bridge
         self.next_infra_name = None
         self.driving_time = 0
 
@@ -350,35 +428,41 @@ class Vehicle(Agent):
                " " + str(self.state) + '(' + str(self.waiting_time) + ') ' + \
                str(self.location) + '(' + str(self.location.vehicle_count) + ') ' + str(self.location_offset)
 
-    def set_path(self):
+    def set_path(self, path_ids=None):
         """
-        Set the origin destination path of the vehicle
+        Set the origin destination path of the vehicle, a random route from its source if no path is given
         """
-        self.path_ids = self.model.get_random_route(self.generated_by.unique_id)
+        if path_ids is None:
+            path_ids = self.model.get_random_route(self.generated_by.unique_id)
+        self.path_ids, self.path_idx, self.path_kind, self.path_length, self.path_bridge = \
+            self.model.get_path_arrays(path_ids)
 
     def step(self):
         """
         Vehicle waits or drives at each step
         """
-        if self.state == Vehicle.State.WAIT:
-            self.waiting_time = max(self.waiting_time - 1, 0)
-            if self.waiting_time == 0:
+        if self.state is Vehicle.State.WAIT:
+            # count down without a call to max(), this runs for every waiting vehicle in every tick
+            self.waiting_time -= 1
+            if self.waiting_time <= 0:
+                self.waiting_time = 0
                 self.waited_at = self.location
                 self.state = Vehicle.State.DRIVE
 
-        if self.state == Vehicle.State.DRIVE:
+        if self.state is Vehicle.State.DRIVE:
             self.drive()
 
         """
-        To print the vehicle trajectory at each step
+        To trace the vehicle trajectory at each step
         """
-        print(self)
+        if self.model.trace_enabled:
+            self.model.trace(self)
 
     def drive(self):
 
         # the distance that vehicle drives in a tick
         # speed is global now: can change to instance object when individual speed is needed
-        distance = Vehicle.speed * Vehicle.step_time
+        distance = VEHICLE_DISTANCE_PER_TICK
         distance_rest = self.location_offset + distance - self.location.length
 
         if distance_rest > 0:
@@ -392,42 +476,49 @@ class Vehicle(Agent):
         """
         vehicle shall move to the next object with the given distance
         """
-
-        self.location_index += 1
-        next_id = self.path_ids[self.location_index]
-        next_infra = self.model.schedule._agents[next_id]  # Access to protected member _agents
-
-        if isinstance(next_infra, Sink):
-            # arrive at the sink
-            self.arrive_at_next(next_infra, 0)
-            self.removed_at_step = self.model.schedule.steps
-            self.driving_time = self.removed_at_step - self.generated_at_step
-            self.model.driving_time_of_trucks.append(self.driving_time)
-            self.location.remove(self)
-            return
-        elif isinstance(next_infra, Bridge):
-            # check if the next bridge is an L or R bridge
-            self.next_infra_name = next_infra.get_name()
-            print(str(self.unique_id), 'will go to next bridge:', self.next_infra_name, ', with location ID', next_id)
-            if self.next_infra_name[-2:] == '(R':
-                self.next_infra_location = next_infra.unique_id
-                print(str(self.unique_id), 'now in', str(self.location), 'will skip the "R" bridge in the next step')
-                return next_infra
-
-            self.waiting_time = next_infra.get_delay_time()
-            if self.waiting_time > 0:
-                # arrive at the bridge and wait
+        while True:
+            # drive over links and intact bridges in one go
+            self.location_index, distance, stop = advance(
+                self.location_index, distance, self.path_kind, self.path_length, self.path_bridge,
+                self.model.bridge_cond, self.model.bridge_right)
+            next_infra = self.model.infra_list[self.path_idx[self.location_index]]
+
+            if stop == AT_SINK:
+                # arrive at the sink
                 self.arrive_at_next(next_infra, 0)
-                self.state = Vehicle.State.WAIT
+                self.removed_at_step = self.model.schedule.steps
+                self.driving_time = self.removed_at_step - self.generated_at_step
+                self.model.record_driving_time(self.driving_time)
+                self.location.remove(self)
                 return
-            # else, continue driving
+            elif stop == AT_BRIDGE:
+                # check if the next bridge is an L or R bridge
+                self.next_infra_name = next_infra.name
+                if self.model.trace_enabled:
+                    self.model.trace(self.unique_id, 'will go to next bridge:', self.next_infra_name,
+                                     ', with location ID', next_infra.unique_id)
+                if next_infra.is_right:
+                    self.next_infra_location = next_infra.unique_id
+                    if self.model.trace_enabled:
+                        self.model.trace(self.unique_id, 'now in', self.location,
+                                         'will skip the "R" bridge in the next step')
+                    return next_infra
+
+                self.waiting_time = next_infra.get_delay_time()
+                if self.waiting_time > 0:
+                    # arrive at the bridge and wait
+                    self.arrive_at_next(next_infra, 0)
+                    self.state = Vehicle.State.WAIT
+                    return
+                # else, continue driving
+                if next_infra.length <= distance:
+                    # drive to next object:
+                    distance -= next_infra.length
+                    continue
 
-        if next_infra.length > distance:
             # stay on this object:
             self.arrive_at_next(next_infra, distance)
-        else:
-            # drive to next object:
-            self.drive_to_next(distance - next_infra.length)
+            return
 
     def arrive_at_next(self, next_infra, location_offset):
         """
@@ -438,4 +529,8 @@ class Vehicle(Agent):
         self.location_offset = location_offset
         self.location.vehicle_count += 1
 
+
+# the distance that every vehicle drives in a tick, folded once from the class constants of Vehicle
+VEHICLE_DISTANCE_PER_TICK = Vehicle.speed * Vehicle.step_time
+
 # EOF -----------------------------------------------------------
@@ -2,10 +2,22 @@ from mesa import Model
 from mesa.time import BaseScheduler
 from mesa.space import ContinuousSpace
 from mesa.datacollection import DataCollector
-from components import Source, Sink, SourceSink, Bridge, Link
+from components import Source, Sink, SourceSink, Bridge, Link, Vehicle, CONDITIONS, X_CODE, LONG_BUCKET, \
+    BRIDGE_KIND
+import heapq
+import numpy as np
 import pandas as pd
 from collections import defaultdict
-from statistics import mean
+
+# the delay time of a collapsed bridge per length bucket is uniform between DELAY_LOW and DELAY_LOW + DELAY_SPAN,
+# except for long bridges, which have a triangular delay time with DELAY_TRIANGULAR as (low, mode, high)
+DELAY_LOW = np.array([10, 15, 45, 0], dtype=np.float64)
+DELAY_SPAN = np.array([10, 45, 45, 0], dtype=np.float64)
+DELAY_TRIANGULAR = (60, 120, 240)
+
+# the arrays of the model with one entry per bridge
+BRIDGE_ARRAYS = ('bridge_cond', 'bridge_cc', 'bridge_repair', 'bridge_delay', 'bridge_right', 'bridge_bucket',
+                 'delay_uniforms', 'delay_buf')
 
 
 # ---------------------------------------------------------------
@@ -17,8 +29,7 @@ def get_avg_delay(model):
     """
     Returns the average delay time
     """
-    delays = [a.delay_time for a in model.schedule.agents if isinstance(a, Bridge)]
-    return mean(delays)
+    return float(model.bridge_delay.mean())
 
 
 def get_avg_driving(model):
@@ -26,12 +37,22 @@ def get_avg_driving(model):
     Returns the average driving time of vehicles on road
     """
 
-    if len(model.driving_time_of_trucks) > 0:
-        return sum(model.driving_time_of_trucks) / len(model.driving_time_of_trucks)
+    if model.n_driving_times > 0:
+        return float(model.driving_time_of_trucks.mean())
     else:
         return 0
 
 
+def triangular_from_uniform(u, low, mode, high):
+    """
+    Transforms uniform samples on [0, 1) into samples of the triangular distribution (inverse CDF)
+    """
+    mode_cdf = (mode - low) / (high - low)
+    return np.where(u < mode_cdf,
+                    low + np.sqrt(u * (high - low) * (mode - low)),
+                    high - np.sqrt((1 - u) * (high - low) * (high - mode)))
+
+
 def set_lat_lon_bound(lat_min, lat_max, lon_min, lon_max, edge_ratio=0.02):
     """
     Set the HTML continuous space canvas bounding box (for visualization)
@@ -76,10 +97,30 @@ class BangladeshModel(Model):
     sinks: list
         all sinks in the network
 
+    source_agents: list
+        the Source agents of all sources in the network
+
+    source_events: list
+        heap of (tick, index in source_agents) at which a source generates its next truck
+
+    generating_sources: list
+        the Source agents that generated a truck in the last tick
+
+    route_sinks: dict
+        Key: source
+        Value: all sinks in the network that a truck from the source can drive to
+
+    rng: np.random.Generator
+        random generator for the vectorized draws (collapses, delay times, routes), seeded from the model seed
+
     collapse_dict: defaultdict
         Key: condition
         Value: the chance that a bridge will collapse for a certain condition
 
+    collapse_chance_by_code: np.ndarray
+        the collapse chance for each condition code, looked up from collapse_dict once
+        (0 for conditions missing in collapse_dict)
+
     long_length_threshold: int
         the length threshold for long bridges
 
@@ -89,23 +130,75 @@ class BangladeshModel(Model):
     short_length_threshold: int
         the length threshold for short bridges
 
-    driving_time_of_trucks: list
-        driving time of all trucks that finished driving a given road
+    driving_time_buf: np.ndarray
+        buffer with the driving time of all trucks that finished driving a given road in its first
+        n_driving_times entries; it doubles in size when it is full
+
+    driving_time_of_trucks: np.ndarray
+        driving time of all trucks that finished driving a given road (a view on driving_time_buf)
+
+    pending_remove: list
+        the vehicles that arrived at a sink in this tick, to be removed from the schedule at the end of the tick
+
+    trace_enabled: bool
+        whether the agents record their trajectory and events in trace_records
+
+    trace_records: list
+        the recorded trace lines (tuples of strings), printed by flush_trace
+
+    bridges: list
+        all bridges in the network, in the order of their index in the bridge arrays
+
+    bridge_cond, bridge_cc, bridge_repair, bridge_delay, bridge_right: np.ndarray
+        the state of all bridges, one entry per bridge:
+        condition code, collapse chance, in repair, delay time and whether it is an R bridge
+
+    repair_events: list
+        heap of (tick, bridge index) at which the repair of a collapsed bridge is finished
+
+    bridge_bucket: np.ndarray
+        the length bucket of every bridge, which determines the distribution of its delay time
+
+    delay_buf: np.ndarray
+        the delay time of every bridge in case it is collapsed, drawn anew each tick
+
+    infra_list: list
+        all infrastructure components in the network, in the order of their dense index (infra_idx)
+
+    infra_idx_dict: dict
+        Key: unique ID of an infrastructure component
+        Value: its dense index in infra_list
+
+    path_arrays_dict: dict
+        Key: (origin, destination)
+        Value: the flattened path (infra IDs, infra indices, kinds, lengths, bridge indices) used by the vehicles
 
     """
 
     step_time = 1
 
     def __init__(self, seed=None, x_max=500, y_max=500, x_min=0, y_min=0,
-                 collapse_dict={'A': 0, 'B': 0, 'C': 0, 'D': 0, 'X': 0}):
+                 collapse_dict={'A': 0, 'B': 0, 'C': 0, 'D': 0, 'X': 0}, trace_enabled=False):
 
+        # the model's own NumPy generator, seeded from the model seed like self.random
+        self.rng = np.random.default_rng(self.random.getrandbits(64))
         self.collapse_dict = collapse_dict
+        self.collapse_chance_by_code = np.array([collapse_dict.get(condition, 0) for condition in CONDITIONS],
+                                                dtype=np.float64)
+        self.trace_enabled = trace_enabled
+        self.trace_records = []
         self.schedule = BaseScheduler(self)
         self.running = True
         self.path_ids_dict = defaultdict(lambda: pd.Series())
         self.space = None
         self.sources = []
         self.sinks = []
+        self.bridges = []
+        self.repair_events = []
+        self.pending_remove = []
+        self.infra_list = []
+        self.infra_idx_dict = {}
+        self.path_arrays_dict = {}
 
         # initialize length threshold for bridges
         self.long_length_threshold = 200
@@ -114,8 +207,22 @@ class BangladeshModel(Model):
 
         self.generate_model()
 
-        # initialize a list to collect the driving times of all trucks that finished driving
-        self.driving_time_of_trucks = []
+        # initialize a buffer to collect the driving times of all trucks that finished driving
+        self.driving_time_buf = np.empty(1024, dtype=np.int32)
+        self.n_driving_times = 0
+
+    @property
+    def driving_time_of_trucks(self):
+        return self.driving_time_buf[:self.n_driving_times]
+
+    def record_driving_time(self, driving_time):
+        """
+        Add the driving time of a truck that finished driving to the buffer
+        """
+        if self.n_driving_times == len(self.driving_time_buf):
+            self.driving_time_buf = np.resize(self.driving_time_buf, 2 * len(self.driving_time_buf))
+        self.driving_time_buf[self.n_driving_times] = driving_time
+        self.n_driving_times += 1
 
     def generate_model(self):
         """
@@ -166,6 +273,18 @@ class BangladeshModel(Model):
             0.05
         )
 
+        # allocate the bridge arrays for the bridges in the data; each Bridge claims its slot when it is created
+        n_bridges = int(sum((df['model_type'] == 'bridge').sum() for df in df_objects_all))
+        self.bridge_cond = np.zeros(n_bridges, dtype=np.uint8)
+        self.bridge_cc = np.zeros(n_bridges, dtype=np.float64)
+        self.bridge_repair = np.zeros(n_bridges, dtype=bool)
+        self.bridge_delay = np.zeros(n_bridges, dtype=np.float64)
+        self.bridge_right = np.zeros(n_bridges, dtype=bool)
+        self.bridge_bucket = np.zeros(n_bridges, dtype=np.intp)
+        # buffers for the delay times that are drawn for all bridges at once each tick
+        self.delay_uniforms = np.empty(n_bridges, dtype=np.float64)
+        self.delay_buf = np.zeros(n_bridges, dtype=np.float64)
+
         # ContinuousSpace from the Mesa package;
         # not to be confused with the SimpleContinuousModule visualization
         self.space = ContinuousSpace(x_max, y_max, True, x_min, y_min)
@@ -200,6 +319,13 @@ class BangladeshModel(Model):
                     self.space.place_agent(agent, (x, y))
                     agent.pos = (x, y)
 
+        # the sources as agents, and the sinks that can be reached from each of them
+        self.source_agents = [self.infra_list[self.infra_idx_dict[source]] for source in self.sources]
+        self.route_sinks = {source: [sink for sink in self.sinks if sink != source] for source in self.sources}
+        # all sources generate their first truck in the first tick
+        self.source_events = [(0, source_number) for source_number in range(len(self.source_agents))]
+        self.generating_sources = []
+
         # define the model metrics we want to extract for each model run
         model_metrics = {
                         "step": get_steps,
@@ -210,6 +336,133 @@ class BangladeshModel(Model):
         # set up the data collector
         self.datacollector = DataCollector(model_reporters=model_metrics)
 
+    def register_infra(self, infra):
+        """
+        Add an infrastructure component to the network and return its dense index in infra_list
+        """
+        self.infra_idx_dict[infra.unique_id] = len(self.infra_list)
+        self.infra_list.append(infra)
+        return len(self.infra_list) - 1
+
+    def register_bridge(self, bridge):
+        """
+        Add a bridge to the network and return its index in the bridge arrays
+
+        The bridge arrays are allocated for the bridges in the data, so they grow by one
+        for every bridge that is added after that
+        """
+        idx = len(self.bridges)
+        if idx == len(self.bridge_cond):
+            for name in BRIDGE_ARRAYS:
+                array = getattr(self, name)
+                setattr(self, name, np.append(array, np.zeros(1, dtype=array.dtype)))
+        self.bridges.append(bridge)
+        return idx
+
+    def get_path_arrays(self, path_ids):
+        """
+        Flatten a path into the arrays of Infra IDs, indices, kinds, lengths and bridge indices the vehicles drive on
+        """
+        key = path_ids.iloc[0], path_ids.iloc[-1]
+        if key not in self.path_arrays_dict:
+            ids = np.asarray(path_ids.values, dtype=np.int32)
+            path_idx = np.fromiter((self.infra_idx_dict[infra_id] for infra_id in path_ids), dtype=np.int32)
+            infras = [self.infra_list[idx] for idx in path_idx]
+            kinds = np.array([infra.kind for infra in infras], dtype=np.int32)
+            lengths = np.array([infra.length for infra in infras], dtype=np.float64)
+            bridges = np.array([infra.idx if infra.kind == BRIDGE_KIND else -1 for infra in infras], dtype=np.int32)
+            self.path_arrays_dict[key] = ids, path_idx, kinds, lengths, bridges
+        return self.path_arrays_dict[key]
+
+    def fill_delay_buf(self):
+        """
+        Draw this tick's delay time of every bridge in case it is collapsed, which depends on its length
+        """
+        u = self.rng.random(out=self.delay_uniforms)
+        bucket = self.bridge_bucket
+        self.delay_buf[:] = DELAY_LOW[bucket] + DELAY_SPAN[bucket] * u
+        # the bridges with a triangular delay time
+        long_bridges = bucket == LONG_BUCKET
+        self.delay_buf[long_bridges] = triangular_from_uniform(u[long_bridges], *DELAY_TRIANGULAR)
+
+    def step_bridges(self):
+        """
+        Let all bridges collapse and get repaired in one vectorized update
+        """
+        self.fill_delay_buf()
+
+        steps = self.schedule.steps
+        cond = self.bridge_cond
+        in_repair = self.bridge_repair
+
+        # the bridges whose repair time is over
+        finish = []
+        while self.repair_events and self.repair_events[0][0] <= steps:
+            finish.append(heapq.heappop(self.repair_events)[1])
+
+        # a bridge that is not in repair collapses according to its chance of collapsing
+        collapsed = (self.rng.random(cond.size) < self.bridge_cc) & ~in_repair
+        cond[collapsed] = X_CODE
+
+        # collapsed bridges go in repair, their repair is finished after the repair time has passed
+        start = np.flatnonzero(~in_repair & (cond == X_CODE))
+        in_repair[start] = True
+        self.bridge_delay[start] = self.delay_buf[start]
+        for bridge_idx in start:
+            repair_time = self.bridges[bridge_idx].repair_time
+            heapq.heappush(self.repair_events, (steps + repair_time + 1, int(bridge_idx)))
+
+        for bridge_idx in finish:
+            self.bridges[bridge_idx].finish_repair()
+
+    def step_sources(self):
+        """
+        Let all sources that are due in this tick generate a truck, in one batch
+
+        Returns the generated trucks
+        """
+        steps = self.schedule.steps
+        # the sources that generated a truck in the previous tick do not anymore
+        for source in self.generating_sources:
+            source.vehicle_generated_flag = False
+
+        # pop the sources that are due in this tick and schedule their next truck
+        sources = []
+        while self.source_events and self.source_events[0][0] <= steps:
+            _, source_number = heapq.heappop(self.source_events)
+            source = self.source_agents[source_number]
+            source.vehicle_generated_flag = True
+            sources.append(source)
+            heapq.heappush(self.source_events, (steps + source.generation_frequency, source_number))
+        self.generating_sources = sources
+
+        truck_ids = np.arange(Source.truck_counter, Source.truck_counter + len(sources))
+        routes = self.get_random_routes([source.unique_id for source in sources])
+        trucks = []
+        for source, truck_id, route in zip(sources, truck_ids, routes):
+            truck = Vehicle('Truck' + str(truck_id), self, source)
+            truck.set_path(route)
+            source.vehicle_count += 1
+            trucks.append(truck)
+            if self.trace_enabled:
+                self.trace(source, "GENERATE", truck)
+        Source.truck_counter += len(trucks)
+        return trucks
+
+    def trace(self, *parts):
+        """
+        Record a trace line; only called by the agents when trace_enabled is set
+        """
+        self.trace_records.append(tuple(str(part) for part in parts))
+
+    def flush_trace(self):
+        """
+        Print the recorded trace lines at the terminal and clear them
+        """
+        for record in self.trace_records:
+            print(*record)
+        self.trace_records.clear()
+
     def get_random_route(self, source):
         """
         pick up a random route given an origin
@@ -221,6 +474,18 @@ class BangladeshModel(Model):
                 break
         return self.path_ids_dict[source, sink]
 
+    def get_random_routes(self, sources):
+        """
+        pick up a random route for each of the given origins, with one draw for all of them
+        """
+        draws = self.rng.random(len(sources))
+        routes = []
+        for source, draw in zip(sources, draws):
+            # different source and sink
+            sinks = self.route_sinks[source]
+            routes.append(self.path_ids_dict[source, sinks[int(draw * len(sinks))]])
+        return routes
+
     def step(self):
         """
         Collect data and advance the simulation by one step.
@@ -229,8 +494,17 @@ class BangladeshModel(Model):
         # collect the model data and add them to the results table
         self.datacollector.collect(self)
 
-        # now lets step the model
+        # now lets step the model, bridges first so that vehicles see this tick's bridge conditions
+        self.step_bridges()
+        trucks = self.step_sources()
         self.schedule.step()
+        # remove the trucks that arrived at a sink in this tick all at once, now no agent is stepping anymore
+        for truck in self.pending_remove:
+            self.schedule.remove(truck)
+        self.pending_remove.clear()
+        # the trucks generated in this tick start driving in the next tick
+        for truck in trucks:
+            self.schedule.add(truck)
 
 
 # EOF -----------------------------------------------------------
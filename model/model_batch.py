@@ -1,47 +1,78 @@
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 from model import BangladeshModel
-from mesa import batch_run
 
 """
     Run simulation
-    Perform batchrunner
+    Run the replications of each scenario in parallel
 """
 
 # ---------------------------------------------------------------
 
-# Define the dictionary with scenario's
-collapse_dict = [{'A': 0, 'B': 0, 'C': 0, 'D': 0},
-                 {'A': 0, 'B': 0, 'C': 0, 'D': 0.05},
-                 {'A': 0, 'B': 0, 'C': 0, 'D': 0.10},
-                 {'A': 0, 'B': 0, 'C': 0.05, 'D': 0.10},
-                 {'A': 0, 'B': 0, 'C': 0.10, 'D': 0.20},
-                 {'A': 0, 'B': 0.05, 'C': 0.10, 'D': 0.20},
-                 {'A': 0, 'B': 0.10, 'C': 0.20, 'D': 0.40},
-                 {'A': 0.05, 'B': 0.10, 'C': 0.20, 'D': 0.40},
-                 {'A': 0.10, 'B': 0.20, 'C': 0.40, 'D': 0.80}]
-
-# Initialize the counter to insert in filename
-scenario: int = 0
-
-# Loop over the scenarios
-for dictionary in collapse_dict:
-    # Define the parameters that need to be assessed by the batch runner
-    params = {"collapse_dict": [dictionary]}
-
-    # Settings of batch runner
-    results = batch_run(
-        BangladeshModel,
-        parameters=params,
-        iterations=10,
-        max_steps=7200,
-        number_processes=1,
-        data_collection_period=7200,
-        display_progress=True)
-
-    # Convert results to dataframe
-    df_results = pd.DataFrame(results)
-    # Convert dataframe to CSV-file
-    df_results.to_csv("../experiment/scenario"+str(scenario)+".csv")
-
-    # Add one to scenario counter
-    scenario += 1
+# run time 5 x 24 hours; 1 tick 1 minute
+max_steps = 7200
+# the model data is reported every data_collection_period ticks
+data_collection_period = 7200
+
+
+def simulate_once(seed, params):
+    """
+    Run one replication of the model with the given seed and model parameters
+
+    Returns the model data at every data collection step
+    """
+    model = BangladeshModel(seed=seed, **params)
+    # the data is collected at the start of each step, so step once more to collect the last step too
+    for _ in range(max_steps + 1):
+        model.step()
+
+    model_vars = model.datacollector.model_vars
+    return [{"Step": step, **params, **{name: values[step] for name, values in model_vars.items()}}
+            for step in range(0, max_steps + 1, data_collection_period)]
+
+
+def run_many(n_runs, params):
+    """
+    Run n_runs independent replications of the model with the given model parameters,
+    spread over all CPUs
+
+    Returns the model data of all replications
+    """
+    seeds = [random.randrange(2 ** 32) for _ in range(n_runs)]
+
+    results = []
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for iteration, run in enumerate(executor.map(simulate_once, seeds, [params] * n_runs)):
+            results.extend({"RunId": iteration, "iteration": iteration, **row} for row in run)
+    return results
+
+
+if __name__ == '__main__':
+    # Define the dictionary with scenario's
+    collapse_dict = [{'A': 0, 'B': 0, 'C': 0, 'D': 0},
+                     {'A': 0, 'B': 0, 'C': 0, 'D': 0.05},
+                     {'A': 0, 'B': 0, 'C': 0, 'D': 0.10},
+                     {'A': 0, 'B': 0, 'C': 0.05, 'D': 0.10},
+                     {'A': 0, 'B': 0, 'C': 0.10, 'D': 0.20},
+                     {'A': 0, 'B': 0.05, 'C': 0.10, 'D': 0.20},
+                     {'A': 0, 'B': 0.10, 'C': 0.20, 'D': 0.40},
+                     {'A': 0.05, 'B': 0.10, 'C': 0.20, 'D': 0.40},
+                     {'A': 0.10, 'B': 0.20, 'C': 0.40, 'D': 0.80}]
+
+    # Initialize the counter to insert in filename
+    scenario: int = 0
+
+    # Loop over the scenarios
+    for dictionary in collapse_dict:
+        # Run 10 replications of the scenario
+        results = run_many(10, {"collapse_dict": dictionary})
+
+        # Convert results to dataframe
+        df_results = pd.DataFrame(results)
+        # Convert dataframe to CSV-file
+        df_results.to_csv("../experiment/scenario"+str(scenario)+".csv")
+
+        # Add one to scenario counter
+        scenario += 1
@@ -14,9 +14,14 @@ run_length = 5 * 24 * 60
 # run time 1000 ticks
 # run_length = 1000
 
+# set to True to print the trajectories of the vehicles at the terminal
+trace = False
+# with trace on, print the recorded trajectories every simulated hour
+trace_flush_period = 60
+
 seed = random.seed()
 
-sim_model = BangladeshModel(seed=seed)
+sim_model = BangladeshModel(seed=seed, trace_enabled=trace)
 
 # Check if the seed is set
 print("SEED " + str(sim_model._seed))
@@ -24,6 +29,12 @@ print("SEED " + str(sim_model._seed))
 # One run with given steps
 for i in range(run_length):
     sim_model.step()
+    if trace and (i + 1) % trace_flush_period == 0:
+        sim_model.flush_trace()
+
+# Print the trajectories of the vehicles that are left
+if trace:
+    sim_model.flush_trace()
 
 model_data = sim_model.datacollector.get_model_vars_dataframe()
 model_data.to_csv("../data/model_data.csv")